@@ -6,11 +6,21 @@ coordinate system 0,0 top left, positive x is right, positive y is down
 rotations are in 90 degree increments clockwise with 0 being left
 """
 
-from itertools import chain
-from functools import reduce
-from random import choice
+from collections import deque
+from functools import cache
+from random import randrange
+from types import FunctionType
 import logging
 
+try:
+    import numpy as np
+except ImportError:  # only needed for Grid.collapse_vectorized
+    np = None
+
+# _collapse_pass loops with range as plain Python, _collapse_kernel swaps in
+# numba's prange when it compiles it
+prange = range
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,19 +29,18 @@ class Position:
     Define a location in two dimensional space
     """
 
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
-    def __key(self):
-        return (self.x, self.y)
-
     def __hash__(self):
-        return hash(self.__key())
+        return hash((self.x, self.y))
 
     def __eq__(self, other):
         if isinstance(other, Position):
-            return self.__key() == other.__key()
+            return self.x == other.x and self.y == other.y
         return NotImplemented
 
     def __repr__(self):
@@ -47,21 +56,21 @@ class Direction:
     This would probably be better called displacement...
     coordinate system 0,0 top left, positive x is right, positive y is down
     rotations are in 90 degree increments clockwise with 0 being left
+    rotate and opposite of the four DIRECTIONS are looked up from a table built once
     """
 
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
-    def __key(self):
-        return (self.x, self.y)
-
     def __hash__(self):
-        return hash(self.__key())
+        return hash((self.x, self.y))
 
     def __eq__(self, other):
         if isinstance(other, Direction):
-            return self.__key() == other.__key()
+            return self.x == other.x and self.y == other.y
         return NotImplemented
 
     def __str__(self):
@@ -71,10 +80,16 @@ class Direction:
         return f"Direction({self.x},{self.y})"
 
     def opposite(self):
+        rotations = _ROTATIONS.get((self.x, self.y))
+        if rotations is not None:
+            return rotations[2]
         return Direction(self.x * -1, self.y * -1)
 
     def rotate(self, amount):
         amount = amount % 4
+        rotations = _ROTATIONS.get((self.x, self.y))
+        if rotations is not None:
+            return rotations[amount]
         if amount == 0:
             return self
         return Direction(-self.y, self.x).rotate(amount - 1)
@@ -85,10 +100,39 @@ class Shape:
     represent the shapes that can be found in a freenet game
     connections are a set of Directions representing the points that the shape touches the edges of the tile
     character is an array of single character strings representing the printable form of the tile in rotation order
+    mask and rotated_masks are the connections as 4 bit masks, unrotated and in rotation order
+    canonical_rot_mask is the rotations that give distinct orientations
+    reach maps a rotation mask to the (can, must) connection masks over those rotations
+    filter_rotations is generated code for collapse with the rotated masks baked in
     """
     def __init__(self, connections, character):
         self.connections = set(connections)
         self.prints_as = character
+        self.mask = sum(1 << DIR_INDEX[connection] for connection in self.connections)
+        self.rotated_masks = [rol4(self.mask, rotation) for rotation in range(4)]
+        self.canonical_rot_mask = self.rotational_symmetry()
+        self.reach = []
+        for rot_mask in range(16):
+            can = 0
+            must = 0xF
+            for rotation in rotations_in(rot_mask):
+                can |= self.rotated_masks[rotation]
+                must &= self.rotated_masks[rotation]
+            self.reach.append((can, must))
+        self.filter_rotations = _specialize_filter(self.rotated_masks)
+
+    def rotational_symmetry(self):
+        """
+        a rotation mask with one rotation for each distinct orientation of the shape
+        """
+        logger.debug("testing rotational symmetry")
+        connections_list = []
+        valid_rotations = 0
+        for rotation, connections in enumerate(self.rotated_masks):
+            if connections not in connections_list:
+                connections_list.append(connections)
+                valid_rotations |= 1 << rotation
+        return valid_rotations
 
     def rotate(self, rotation):
         return {connection.rotate(rotation) for connection in self.connections}
@@ -99,14 +143,14 @@ class Piece:
     A piece on the freenet grid
     Has a Shape, a Position, a rotation
     in addition keeps track of the allowed rotations for that piece
+    as rot_mask, a 4 bit mask with bit n set if rotation n is still possible
     """
     def __init__(self, shape, position, rotation=0):
         self.shape = shape
-        self.rotation = rotation
+        self.rotation = rotation % 4
         self.position = position
-        self.connections = self.shape.connections
-        self.possible_rotations = list(range(0, 4))
-        self.rotational_symmetry()
+        self.connections = self.shape.rotated_masks[self.rotation]
+        self.rot_mask = self.shape.canonical_rot_mask
 
     def __str__(self):
         return self.prints_as()
@@ -114,38 +158,16 @@ class Piece:
     def prints_as(self):
         return self.shape.prints_as[self.rotation]
 
-    def set_rotation(self, rotation):
-        self.rotation = rotation % 4
-        self.connections = self.shape.rotate(self.rotation)
-
-    def canconnect(self, direction):
-        if len(self.connections) == 0:
-            return False
-        for rotation in self.possible_rotations:
-            if direction in self.shape.rotate(rotation):
-                return True
-        return False
-
-    def mustconnect(self, direction):
-        if all(
-            [
-                direction in self.shape.rotate(rotation)
-                for rotation in self.possible_rotations
-            ]
-        ):
-            return True
-        return False
+    @property
+    def possible_rotations(self):
+        return list(CHOICE_TABLE[self.rot_mask])
 
-    def rotational_symmetry(self):
-        logger.debug("testing rotational symmetry")
-        connections_list = []
-        valid_rotations = []
-        for rotation in self.possible_rotations:
-            connections = self.shape.rotate(rotation)
-            if connections not in connections_list:
-                connections_list.append(connections)
-                valid_rotations.append(rotation)
-        self.possible_rotations = valid_rotations
+    def set_rotation(self, rotation):
+        rotation = rotation % 4
+        if rotation == self.rotation:
+            return
+        self.rotation = rotation
+        self.connections = self.shape.rotated_masks[self.rotation]
 
 
 class Grid:
@@ -155,73 +177,227 @@ class Grid:
     def __init__(self, description):
         # test description is a square array of arrays
         # test description is an array of array of strings
-        self.grid = [
-            [Piece(SHAPES[cell], Position(x, y)) for x, cell in enumerate(row)]
+        # pieces are stored row by row in a single list, index y * x_max + x
+        self._flat = [
+            Piece(SHAPES[cell], Position(x, y))
             for y, row in enumerate(description)
+            for x, cell in enumerate(row)
         ]
-        self.x_max = len(self.grid[0])
-        self.y_max = len(self.grid)
-
-    def ingrid(self, position):
-        x = position.x
-        y = position.y
-        return 0 <= x < self.x_max and 0 <= y < self.y_max
+        self.x_max = len(description[0])
+        self.y_max = len(description)
+        self._perm = 1
+        for cell in self._flat:
+            self._perm *= cell.rot_mask.bit_count()
 
-    def piece(self, position):
-        if self.ingrid(position):
-            return self.grid[position.y][position.x]
-        return Piece(SHAPES["Edge"], position)
+    def piece_at(self, x, y):
+        if 0 <= x < self.x_max and 0 <= y < self.y_max:
+            return self._flat[y * self.x_max + x]
+        return EDGE_PIECE
 
     def prints_as(self):
-        return "\n".join(
-            ["".join([cell.prints_as() for cell in row]) for row in self.grid]
-        )
+        rows = [
+            self._flat[y * self.x_max : (y + 1) * self.x_max] for y in range(self.y_max)
+        ]
+        return "\n".join(["".join([cell.prints_as() for cell in row]) for row in rows])
 
     def permutations(self):
-        return reduce(
-            lambda a, e: a * len(e.possible_rotations),
-            chain.from_iterable(self.grid),
-            1,
-        )
-
-    def neighbours(self, position):
-        neighbours = set()
-        for direction in DIRECTIONS:
-            neighbours.add((direction, self.piece(position.move(direction))))
-        return neighbours
+        return self._perm
+
+    def shrink_rotations(self, piece, rot_mask):
+        """
+        narrow the rotations of piece to rot_mask, keeping the permutation count
+        returns whether anything changed
+        """
+        if rot_mask == 0:
+            raise ValueError(f"no rotation of the piece at {piece.position} fits")
+        if rot_mask == piece.rot_mask:
+            return False
+        self._perm = self._perm // piece.rot_mask.bit_count() * rot_mask.bit_count()
+        piece.rot_mask = rot_mask
+        return True
 
     def collapse(self, focus):
-        logger.debug(f"---=== collapsing {focus.position}")
-        logger.debug(f"before: {focus}")
-        valid_directions = set()
-        mandatory_directions = set()
-        for direction, neighbour in self.neighbours(focus.position):
-            logger.debug(f"{direction}")
-            logger.debug(f"{neighbour}")
-            if neighbour.canconnect(direction.opposite()):
-                valid_directions.add(direction)
-                logger.debug("valid")
-            if neighbour.mustconnect(direction.opposite()):
-                mandatory_directions.add(direction)
+        logger.debug("---=== collapsing %s", focus.position)
+        logger.debug("before: %s", focus)
+        valid_mask = 0
+        mandatory_mask = 0
+        x = focus.position.x
+        y = focus.position.y
+        for direction, dx, dy, bit, opposite_bit in NEIGHBOUR_OFFSETS:
+            nx = x + dx
+            ny = y + dy
+            if 0 <= nx < self.x_max and 0 <= ny < self.y_max:
+                neighbour = self._flat[ny * self.x_max + nx]
+            else:
+                neighbour = EDGE_PIECE
+            logger.debug("%s", direction)
+            logger.debug("%s", neighbour)
+            can, must = neighbour.shape.reach[neighbour.rot_mask]
+            if can & opposite_bit:
+                valid_mask |= bit
                 logger.debug("valid")
-        valid_rotations = []
-        for rotation in focus.possible_rotations:
-            connections = focus.shape.rotate(rotation)
-            logger.debug(f"rotation: {rotation},{connections}")
-            if connections.issubset(valid_directions) and mandatory_directions.issubset(
-                connections
-            ):
+            if must & opposite_bit:
+                mandatory_mask |= bit
                 logger.debug("valid")
-                valid_rotations.append(rotation)
-        focus.possible_rotations = valid_rotations
-        focus.set_rotation(choice(focus.possible_rotations))
-        logger.debug(f"after: {focus}")
+        valid_rotations = focus.shape.filter_rotations(
+            focus.rot_mask, valid_mask, mandatory_mask
+        )
+        logger.debug("rotations: %s", CHOICE_TABLE[valid_rotations])
+        changed = self.shrink_rotations(focus, valid_rotations)
+        choices = CHOICE_TABLE[valid_rotations]
+        focus.set_rotation(choices[randrange(len(choices))])
+        logger.debug("after: %s", focus)
+        return changed
+
+    def propagate(self):
+        """
+        collapse pieces until none of them change
+        after the first pass only neighbours of pieces that lost rotations are revisited
+        """
+        worklist = deque(self._flat)
+        queued = set(worklist)
+        while worklist:
+            focus = worklist.popleft()
+            queued.remove(focus)
+            if not self.collapse(focus):
+                continue
+            x = focus.position.x
+            y = focus.position.y
+            for _, dx, dy, _, _ in NEIGHBOUR_OFFSETS:
+                neighbour = self.piece_at(x + dx, y + dy)
+                if neighbour is not EDGE_PIECE and neighbour not in queued:
+                    worklist.append(neighbour)
+                    queued.add(neighbour)
+
+    def collapse_vectorized(self):
+        """
+        collapse every piece at once with numpy, repeating until nothing changes
+        """
+        if np is None:
+            raise RuntimeError("collapse_vectorized requires numpy")
+        collapse_pass = _collapse_kernel()
+        shape_id = np.array(
+            [SHAPE_INDEX[cell.shape] for cell in self._flat], dtype=np.intp
+        ).reshape(self.y_max, self.x_max)
+        possible = np.array(
+            [cell.rot_mask for cell in self._flat], dtype=np.uint8
+        ).reshape(self.y_max, self.x_max)
+        while True:
+            collapsed = collapse_pass(shape_id, possible, ROT_MASKS)
+            if np.array_equal(collapsed, possible):
+                break
+            possible = collapsed
+        if not possible.all():
+            y, x = np.argwhere(possible == 0)[0]
+            raise ValueError(f"no rotation of the piece at {Position(x, y)} fits")
+        for cell, mask in zip(self._flat, possible.flat):
+            self.shrink_rotations(cell, int(mask))
+            choices = CHOICE_TABLE[cell.rot_mask]
+            cell.set_rotation(choices[randrange(len(choices))])
+
+
+@cache
+def _collapse_kernel():
+    """
+    the pass collapse_vectorized runs, importing numba the first time it is asked for
+    _collapse_pass compiled with numba if it is installed, vectorized_pass otherwise
+    """
+    try:
+        import numba
+    except ImportError:
+        return vectorized_pass
+    kernel = FunctionType(
+        _collapse_pass.__code__,
+        dict(globals(), prange=numba.prange),
+        _collapse_pass.__name__,
+    )
+    return numba.njit(cache=True, parallel=True)(kernel)
+
+
+def vectorized_pass(shape_id, possible, rot_masks):
+    """
+    a single collapse of a whole grid held as arrays
+    shape_id is the SHAPE_INDEX of each piece
+    possible is a 4 bit mask of the rotations each piece may still take
+    rot_masks is the rotated_masks of each shape, as ROT_MASKS
+    returns the new possible masks
+    """
+    height, width = shape_id.shape
+    rotated = rot_masks[shape_id]
+    rotations = np.arange(4, dtype=np.uint8)
+    allowed = (possible[..., np.newaxis] >> rotations) & 1 == 1
+    # directions each piece connects in for some/every possible rotation
+    # padded with zeros as the edge never connects
+    reach = np.pad(np.bitwise_or.reduce(np.where(allowed, rotated, 0), axis=-1), 1)
+    fixed = np.pad(np.bitwise_and.reduce(np.where(allowed, rotated, 0xF), axis=-1), 1)
+    valid = np.zeros_like(possible)
+    mandatory = np.zeros_like(possible)
+    for index, direction in enumerate(DIRECTIONS):
+        neighbours = (
+            slice(1 + direction.y, 1 + direction.y + height),
+            slice(1 + direction.x, 1 + direction.x + width),
+        )
+        opposite = DIR_INDEX[direction.opposite()]
+        valid |= ((reach[neighbours] >> opposite) & 1) << index
+        mandatory |= ((fixed[neighbours] >> opposite) & 1) << index
+    fits = (
+        allowed
+        & ((rotated & ~valid[..., np.newaxis]) == 0)
+        & ((mandatory[..., np.newaxis] & ~rotated) == 0)
+    )
+    return np.bitwise_or.reduce(fits.astype(np.uint8) << rotations, axis=-1)
+
+
+def _collapse_pass(shape_id, possible, rot_masks):
+    """
+    the same pass as vectorized_pass written as loops over the cells, for numba
+    plain Python when called directly, which is slow but handy for checking the kernel
+    """
+    height, width = shape_id.shape
+    reach = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    fixed = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    for y in prange(height):
+        for x in range(width):
+            can = 0
+            must = 0xF
+            for rotation in range(4):
+                if possible[y, x] >> rotation & 1:
+                    connections = rot_masks[shape_id[y, x], rotation]
+                    can |= connections
+                    must &= connections
+            reach[y + 1, x + 1] = can
+            fixed[y + 1, x + 1] = must
+    collapsed = np.zeros_like(possible)
+    for y in prange(height):
+        for x in range(width):
+            # neighbours in DIRECTIONS order, each tested for the opposite connection
+            valid = (
+                (reach[y + 1, x] >> 2 & 1)
+                | (reach[y, x + 1] >> 3 & 1) << 1
+                | (reach[y + 1, x + 2] & 1) << 2
+                | (reach[y + 2, x + 1] >> 1 & 1) << 3
+            )
+            mandatory = (
+                (fixed[y + 1, x] >> 2 & 1)
+                | (fixed[y, x + 1] >> 3 & 1) << 1
+                | (fixed[y + 1, x + 2] & 1) << 2
+                | (fixed[y + 2, x + 1] >> 1 & 1) << 3
+            )
+            for rotation in range(4):
+                connections = rot_masks[shape_id[y, x], rotation]
+                if (
+                    possible[y, x] >> rotation & 1
+                    and (connections & ~valid) == 0
+                    and (mandatory & ~connections) == 0
+                ):
+                    collapsed[y, x] |= 1 << rotation
+    return collapsed
 
 
 LEFT = Direction(-1, 0)
-UP = LEFT.rotate(1)
-RIGHT = LEFT.rotate(2)
-DOWN = LEFT.rotate(3)
+UP = Direction(0, -1)
+RIGHT = Direction(1, 0)
+DOWN = Direction(0, 1)
 
 DIRECTIONS = [
     LEFT,
@@ -230,6 +406,62 @@ DIRECTIONS = [
     DOWN,
 ]
 
+# DIRECTIONS are in clockwise order so rotating is stepping along the list
+_ROTATIONS = {
+    (direction.x, direction.y): [DIRECTIONS[(index + step) % 4] for step in range(4)]
+    for index, direction in enumerate(DIRECTIONS)
+}
+
+# connections are encoded as a 4 bit mask, bit n set meaning DIRECTIONS[n] is connected
+# so rotating clockwise by one step is a left rotate of the mask
+DIR_INDEX = {direction: index for index, direction in enumerate(DIRECTIONS)}
+
+# (direction, dx, dy, direction bit, opposite direction bit) for walking the neighbours
+NEIGHBOUR_OFFSETS = [
+    (direction, direction.x, direction.y, 1 << index, 1 << (index + 2) % 4)
+    for index, direction in enumerate(DIRECTIONS)
+]
+
+
+def rol4(mask, amount):
+    amount = amount % 4
+    return ((mask << amount) | (mask >> (4 - amount))) & 0xF
+
+
+def rotations_in(mask):
+    """
+    the rotations set in a rotation mask, lowest first
+    """
+    while mask:
+        yield (mask & -mask).bit_length() - 1
+        mask &= mask - 1
+
+
+# the rotations in each possible rotation mask
+CHOICE_TABLE = [tuple(rotations_in(mask)) for mask in range(16)]
+
+
+def _specialize_filter(rotated_masks):
+    """
+    generate the rotation filter of Grid.collapse for one shape
+    the returned function takes the piece's rotation mask and the masks of directions
+    the neighbours can and must connect in, and returns the rotations that still fit
+    each rotation is a single test against constants, with no loops or lookups
+    """
+    lines = ["def filter_rotations(rot_mask, valid, mandatory):", "    possible = 0"]
+    for rotation, connections in enumerate(rotated_masks):
+        lines.append(
+            f"    if rot_mask & {1 << rotation}"
+            f" and valid & {connections} == {connections}"
+            f" and not mandatory & {~connections & 0xF}:"
+        )
+        lines.append(f"        possible |= {1 << rotation}")
+    lines.append("    return possible")
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["filter_rotations"]
+
+
 SHAPES = {
     "Corner": Shape(
         [LEFT, UP],
@@ -270,6 +502,17 @@ SHAPES = {
     "Edge": Shape([], ["", "", "", ""]),
 }
 
+# everything outside the grid is the same edge, it has no connections so its
+# position is never looked at
+EDGE_PIECE = Piece(SHAPES["Edge"], Position(-1, -1))
+
+# lookup tables for the vectorized solver
+SHAPE_INDEX = {shape: index for index, shape in enumerate(SHAPES.values())}
+if np is not None:
+    ROT_MASKS = np.array(
+        [shape.rotated_masks for shape in SHAPES.values()], dtype=np.uint8
+    )
+
 TEST = [
     [
         "End",
@@ -307,13 +550,11 @@ SAMPLE = [
 
 def main():
     grid = Grid(SAMPLE)
-    previous_permutations = grid.permutations() + 1
     print(grid.permutations())
     print(grid.prints_as(), "\n")
-    while grid.permutations() > 1 and previous_permutations != grid.permutations():
-        [grid.collapse(cell) for row in grid.grid for cell in row]
-        print(grid.permutations())
-        print(grid.prints_as(), "\n")
+    grid.propagate()
+    print(grid.permutations())
+    print(grid.prints_as(), "\n")
 
 
 if __name__ == "__main__":
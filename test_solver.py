@@ -0,0 +1,110 @@
+import random
+import unittest
+
+import solver
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def random_puzzle(width, height, rng):
+    """
+    a solvable description made from the shapes along a random spanning tree of the grid
+    no piece gets all four connections as there is no shape for that
+    """
+    while True:
+        connections = {(x, y): [] for x in range(width) for y in range(height)}
+        seen = {(0, 0)}
+        frontier = [((0, 0), direction) for direction in solver.DIRECTIONS]
+        while frontier:
+            position, direction = frontier.pop(rng.randrange(len(frontier)))
+            neighbour = (position[0] + direction.x, position[1] + direction.y)
+            if neighbour not in connections or neighbour in seen:
+                continue
+            if len(connections[position]) == 3:
+                continue
+            connections[position].append(direction)
+            connections[neighbour].append(direction.opposite())
+            seen.add(neighbour)
+            frontier.extend((neighbour, other) for other in solver.DIRECTIONS)
+        if len(seen) == width * height:
+            break
+    description = []
+    for y in range(height):
+        row = []
+        for x in range(width):
+            directions = connections[(x, y)]
+            if len(directions) == 1:
+                row.append("End")
+            elif len(directions) == 3:
+                row.append("Tee")
+            elif directions[0].opposite() == directions[1]:
+                row.append("Straight")
+            else:
+                row.append("Corner")
+        description.append(row)
+    return description
+
+
+class PropagateTest(unittest.TestCase):
+    def test_sample_solves(self):
+        grid = solver.Grid(solver.SAMPLE)
+        grid.propagate()
+        self.assertEqual(grid.permutations(), 1)
+        for y in range(grid.y_max):
+            for x in range(grid.x_max):
+                piece = grid.piece_at(x, y)
+                for direction, dx, dy, bit, opposite_bit in solver.NEIGHBOUR_OFFSETS:
+                    neighbour = grid.piece_at(x + dx, y + dy)
+                    self.assertEqual(
+                        bool(piece.connections & bit),
+                        bool(neighbour.connections & opposite_bit),
+                    )
+
+    def test_contradiction_raises(self):
+        grid = solver.Grid(solver.TEST)
+        with self.assertRaisesRegex(ValueError, "no rotation"):
+            grid.propagate()
+        self.assertTrue(all(piece.rot_mask for piece in grid._flat))
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class VectorizedTest(unittest.TestCase):
+    def test_passes_agree(self):
+        kernel = solver._collapse_kernel()
+        rng = np.random.default_rng(0)
+        for _ in range(100):
+            height, width = rng.integers(1, 10, 2)
+            shape_id = rng.integers(0, len(solver.SHAPES), (height, width))
+            possible = rng.integers(0, 16, (height, width)).astype(np.uint8)
+            expected = solver.vectorized_pass(shape_id, possible, solver.ROT_MASKS)
+            looped = solver._collapse_pass(shape_id, possible, solver.ROT_MASKS)
+            np.testing.assert_array_equal(looped, expected)
+            if numba is not None:
+                compiled = kernel(shape_id, possible, solver.ROT_MASKS)
+                np.testing.assert_array_equal(compiled, expected)
+
+    def test_matches_propagate(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            description = random_puzzle(rng.randint(2, 8), rng.randint(2, 8), rng)
+            propagated = solver.Grid(description)
+            propagated.propagate()
+            vectorized = solver.Grid(description)
+            vectorized.collapse_vectorized()
+            self.assertEqual(
+                [piece.rot_mask for piece in propagated._flat],
+                [piece.rot_mask for piece in vectorized._flat],
+            )
+            self.assertEqual(propagated.permutations(), vectorized.permutations())
+
+
+if __name__ == "__main__":
+    unittest.main()